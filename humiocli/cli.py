@@ -1,22 +1,19 @@
 #!/usr/bin/env python3
 
+import io
 import json
+import logging
 import csv
 import sys
 import os
 import re
 import shlex
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from textwrap import shorten
 from pathlib import Path
 
 import click
-import colorama
-import pendulum
 import structlog
-import tzlocal
-from pygments.styles import get_all_styles
-from tabulate import tabulate
 
 import humioapi
 from humiocli import prettyxml, utils
@@ -26,6 +23,40 @@ humioapi.humio_loadenv()
 
 logger = structlog.getLogger(__name__)
 
+# Regex for finding {{field}} tokens in search queries
+QUERY_TOKEN = re.compile(r"\{\{ *(?P<token>[@#._]?[\w.-]+) *\}\}")
+
+# Supported syntax highlighting styles, all bundled with the required Pygments version
+HIGHLIGHT_STYLES = (
+    "bw",
+    "monokai",
+    "paraiso-dark",
+    "paraiso-light",
+    "solarized-dark",
+    "solarized-light",
+    "tango",
+)
+
+# Buffer size for reading files and STDIN during ingest, fewer and larger reads for big inputs
+READ_BUFFER_SIZE = 2 ** 20
+
+# Column headers for the short and long repository listings
+REPO_SHORT_HEADERS = ("Repository name", "Type", "Description")
+REPO_LONG_HEADERS = (
+    "Repository name",
+    "Last ingest",
+    "Real size",
+    "Read",
+    "Write",
+    "Parsers",
+    "Alerts",
+    "Dashboards",
+    "Queries",
+    "Files",
+    "Type",
+    "Description",
+)
+
 
 class AliasedGroup(click.Group):
     """Helper class for expanding partial command names to matching commands"""
@@ -54,6 +85,17 @@ class OptionWithEnvinfo(click.Option):
         return help_record
 
 
+def validate_regex(ctx, param, value):
+    """Click callback ensuring an option is a valid regex, since it is compiled long after parsing"""
+
+    if value:
+        try:
+            re.compile(value)
+        except re.error as err:
+            raise click.BadParameter(f"Invalid regex: {err}")
+    return value
+
+
 @click.group(cls=AliasedGroup, context_settings=dict(help_option_names=["-h", "--help"], max_content_width=120))
 @click.option(
     "-v",
@@ -83,6 +125,12 @@ def cli(verbosity):
     level_map = {0: 30, 1: 20, 2: 10, 3: 5}
     humioapi.initialize_logging(fmt="human", level=level_map.get(verbosity, 0))
 
+    # Drop log calls below the configured level before any other processor runs, since
+    # the processors from humioapi add timestamps and inspect the stack for every call
+    processors = structlog.get_config()["processors"]
+    if processors[0] is not structlog.stdlib.filter_by_level:
+        structlog.configure(processors=[structlog.stdlib.filter_by_level] + processors)
+
 
 @cli.command(short_help="Search for data in Humio")
 @click.option(
@@ -180,27 +228,21 @@ def cli(verbosity):
     "--style",
     envvar="HUMIO_STYLE",
     default="paraiso-dark",
-    type=click.Choice(
-        sorted(
-            set(get_all_styles()).intersection(
-                {
-                    "paraiso-dark",
-                    "paraiso-light",
-                    "solarized-dark",
-                    "solarized-light",
-                    "tango",
-                    "bw",
-                    "monokai",
-                }
-            )
-        )
-    ),
+    type=click.Choice(HIGHLIGHT_STYLES),
     show_default=True,
     help="Pygments style to use when syntax-highlighting",
     cls=OptionWithEnvinfo,
 )
+@click.option(
+    "--compact/--no-compact",
+    envvar="HUMIO_COMPACT",
+    default=False,
+    show_default=True,
+    help="Emit JSON without spaces after separators. Faster with the orjson extra installed",
+    cls=OptionWithEnvinfo,
+)
 @click.argument("query", envvar="HUMIO_QUERY")
-def search(base_url, token, repo_, start, stop, color, outformat, sort, fields, style, query):
+def search(base_url, token, repo_, start, stop, color, outformat, sort, fields, style, compact, query):
     """
     Execute a QUERY against the Humio API in the provided time range. QUERY may contain optional
     tokens to inject provided fields into the query wherever `{{field}}` occurs. These fields must
@@ -216,28 +258,25 @@ def search(base_url, token, repo_, start, stop, color, outformat, sort, fields,
     utils.color_init(color)
 
     # Check for tokens in the query string and load fields if necessary
-    token_pattern = re.compile(r"\{\{ *(?P<token>[@#._]?[\w.-]+) *\}\}")
-    tokens = token_pattern.findall(query)
+    tokens = QUERY_TOKEN.findall(query) if "{{" in query else []
     if tokens:
         logger.debug("Query contains valid tokens, loading provided JSON fields", tokens=tokens)
         if fields:
             logger.debug("JSON-data read from --fields", json=fields)
-            fields = json.loads(fields)
+            fields = utils.json_loads(fields)
         else:
             logger.debug("Expecting one line of JSON-data from STDIN before proceeding")
-            in_stream = click.get_text_stream("stdin").readline()
+            in_stream = click.get_binary_stream("stdin").readline()
             logger.debug("JSON-data read from STDIN", json=in_stream)
-            fields = json.loads(in_stream)
+            fields = utils.json_loads(in_stream)
     else:
         fields = {}
 
-    def token_sub(matchobj):
-        if matchobj.group(1) in fields:
-            return fields.get(matchobj.group(1))
-        return matchobj.group(0)
-
-    query = token_pattern.sub(token_sub, query)
-    logger.info("Prepared query", query=query, repo=repo_, fields=json.dumps(fields))
+    if tokens:
+        # Substitute every token in a single pass, so text from inserted values is never substituted again
+        query = QUERY_TOKEN.sub(lambda match: fields.get(match.group("token"), match.group(0)), query)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("Prepared query", query=query, repo=repo_, fields=json.dumps(fields))
 
     client = humioapi.HumioAPI(base_url=base_url, token=token)
     events = client.streaming_search(query, repo_, start, stop)
@@ -251,26 +290,44 @@ def search(base_url, token, repo_, start, stop, color, outformat, sort, fields,
         if searchstrings.get("SUBSEARCH") == "()":
             logger.error("Search did not produce any results, unable to generate search strings")
         else:
-            print(json.dumps(searchstrings, ensure_ascii=False))
+            print(utils.json_dumps(searchstrings, compact=compact))
         sys.exit(0)
 
     elif outformat == "table":
         print(utils.table_from_events(events))
 
     else:
-        order = lambda x: sorted(events, key=lambda e: e.get(sort, 0)) if sort else x  # noqa
-        for event in order(events):
-            if outformat == "ndjson" or "@rawstring" not in event:
-                output = json.dumps(event, ensure_ascii=False, sort_keys=True)
-            elif outformat == "pretty":
-                output = prettyxml.process(event.get("@rawstring"))
-            else:
-                output = event.get("@rawstring")
-
-            if color == "always" or color == "auto" and sys.stdout.isatty():
-                print(utils.highlight(output, style=style))
-            else:
-                print(output)
+        colorize = color == "always" or color == "auto" and sys.stdout.isatty()
+
+        # Write events in batches when piped, but keep interactive output responsive
+        batch_size = 1 if sys.stdout.isatty() else 256
+        batch = []
+
+        if sort:
+            # Sorting requires holding all events in memory
+            events = sorted(events, key=lambda e: e.get(sort, 0))
+
+        try:
+            for event in events:
+                rawstring = event.get("@rawstring")
+                if outformat == "ndjson" or rawstring is None:
+                    output = utils.json_dumps(event, sort_keys=True, compact=compact)
+                elif outformat == "pretty":
+                    output = prettyxml.process(rawstring)
+                else:
+                    output = rawstring
+
+                if colorize:
+                    output = utils.highlight(output, style=style)
+                batch.append(output)
+
+                if len(batch) >= batch_size:
+                    sys.stdout.write("\n".join(batch) + "\n")
+                    batch.clear()
+        finally:
+            if batch:
+                sys.stdout.write("\n".join(batch) + "\n")
+            sys.stdout.flush()
 
     if utils.is_tty():
         url = humioapi.utils.create_humio_url(base_url, repo_, query, start, stop, scheme="https")
@@ -324,6 +381,7 @@ def search(base_url, token, repo_, start, stop, color, outformat, sort, fields,
     type=str,
     help="Ignore repositories and views with names matching the provided pattern. Pass the empty "
     "string to disable this option.",
+    callback=validate_regex,
     cls=OptionWithEnvinfo,
 )
 @click.option(
@@ -336,77 +394,97 @@ def search(base_url, token, repo_, start, stop, color, outformat, sort, fields,
     help="Output format when emitting repositories and views.",
     cls=OptionWithEnvinfo,
 )
+@click.option(
+    "--no-cache",
+    "no_cache",
+    envvar="HUMIO_NO_CACHE",
+    is_flag=True,
+    default=False,
+    help="Always fetch a fresh list of repositories and views instead of reusing one cached in "
+    "~/.cache/humio for up to 60 seconds.",
+    cls=OptionWithEnvinfo,
+)
 @click.argument("PATTERNS", nargs=-1)
-def repo(base_url, token, long_listing, color, ignore_repo, outformat, patterns):
+def repo(base_url, token, long_listing, color, ignore_repo, outformat, no_cache, patterns):
     """List available repositories and views matching an optional filter."""
+    import colorama
+    import pendulum
+    from tabulate import tabulate
+
     utils.color_init(color)
 
     client = humioapi.HumioAPI(base_url=base_url, token=token)
 
     fast = not long_listing
     repositories = utils.filter_repositories(
-        client.repositories(fast=fast), patterns, ignore=ignore_repo, strict_views=False
+        utils.cached_repositories(client, fast=fast, ttl=0 if no_cache else 60),
+        patterns,
+        ignore=ignore_repo,
+        strict_views=False,
     )
 
     if outformat == "ipython":
         utils.run_ipython({"repositories": repositories, "client": client, "humioapi": humioapi})
         sys.exit(0)
 
+    emoji_ok = colorama.Fore.GREEN + "✓" + colorama.Style.RESET_ALL
+    emoji_no = colorama.Fore.RED + "✗" + colorama.Style.RESET_ALL
+
     def _emojify(authorized):
-        if authorized:
-            return f"{colorama.Fore.GREEN}✓{colorama.Style.RESET_ALL}"
-        return f"{colorama.Fore.RED}✗{colorama.Style.RESET_ALL}"
+        return emoji_ok if authorized else emoji_no
 
     if outformat == "raw":
+        lines = []
         for reponame, meta in sorted(repositories.items()):
             last_ingest = meta.get("last_ingest")
             if last_ingest:
                 meta["last_ingest"] = str(last_ingest)
             meta["name"] = reponame
-            print(json.dumps(meta, ensure_ascii=False))
+            lines.append(json.dumps(meta, ensure_ascii=False) + "\n")
+        sys.stdout.write("".join(lines))
         sys.exit(0)
 
-    output = []
+    now = pendulum.now()
+    reset = colorama.Style.RESET_ALL
 
     def make_short_listing(reponame, meta):
-        return {
-            "Repository name": reponame,
-            "Type": meta.get("type"),
-            "Description": shorten(meta.get("description", ""), 110),
-        }
+        return [reponame, meta.get("type"), shorten(meta.get("description", ""), 110)]
 
     def make_long_listing(reponame, meta):
         readable = meta.get("read_permission", False)
         colorprefix = colorama.Fore.GREEN if readable else colorama.Fore.RED
 
-        try:
-            last_ingest = meta.get("last_ingest").in_timezone(tzlocal.get_localzone())
-            last_ingest = pendulum.now().diff_for_humans(last_ingest, True) + " ago"
-        except (TypeError, AttributeError):
-            last_ingest = colorama.Fore.RED + "no events" + colorama.Style.RESET_ALL
-
-        return {
-            "Repository name": colorprefix + reponame + colorama.Style.RESET_ALL,
-            "Last ingest": last_ingest,
-            "Real size": utils.humanized_bytes(meta.get("uncompressed_bytes")),
-            "Read": _emojify(meta.get("read_permission")),
-            "Write": _emojify(meta.get("write_permission")),
-            "Parsers": _emojify(meta.get("parseradmin_permission")),
-            "Alerts": _emojify(meta.get("alertadmin_permission")),
-            "Dashboards": _emojify(meta.get("parseradmin_permission")),
-            "Queries": _emojify(meta.get("parseradmin_permission")),
-            "Files": _emojify(meta.get("parseradmin_permission")),
-            "Type": meta.get("type"),
-            "Description": shorten(meta.get("description", ""), 40),
-        }
-
-    for reponame, meta in sorted(repositories.items()):
-        if long_listing:
-            output.append(make_long_listing(reponame, meta))
+        # The humanized difference doesn't depend on timezone, so no conversion is needed
+        last_ingest = meta.get("last_ingest")
+        if last_ingest is not None:
+            last_ingest = now.diff_for_humans(last_ingest, True) + " ago"
         else:
-            output.append(make_short_listing(reponame, meta))
+            last_ingest = colorama.Fore.RED + "no events" + reset
+
+        return [
+            colorprefix + reponame + reset,
+            last_ingest,
+            utils.humanized_bytes(meta.get("uncompressed_bytes")),
+            _emojify(meta.get("read_permission")),
+            _emojify(meta.get("write_permission")),
+            _emojify(meta.get("parseradmin_permission")),
+            _emojify(meta.get("alertadmin_permission")),
+            _emojify(meta.get("dashboardadmin_permission")),
+            _emojify(meta.get("queryadmin_permission")),
+            _emojify(meta.get("fileadmin_permission")),
+            meta.get("type"),
+            shorten(meta.get("description", ""), 40),
+        ]
+
+    if long_listing:
+        headers = REPO_LONG_HEADERS
+        make_listing = make_long_listing
+    else:
+        headers = REPO_SHORT_HEADERS
+        make_listing = make_short_listing
 
-    print(tabulate(output, headers="keys"))
+    rows = [make_listing(reponame, meta) for reponame, meta in sorted(repositories.items())]
+    print(tabulate(rows, headers=headers))
 
 
 @cli.command(short_help="Ingests events from files or STDIN into Humio")
@@ -462,7 +540,7 @@ def repo(base_url, token, long_listing, color, ignore_repo, outformat, patterns)
     "--encoding",
     envvar="HUMIO_ENCODING",
     required=False,
-    help="Encoding to use when reading the provided files. Autodetected if not provided",
+    help="Encoding to use when reading the provided files or STDIN. Autodetected for files if not provided",
     cls=OptionWithEnvinfo,
 )
 @click.option(
@@ -494,47 +572,57 @@ def ingest(base_url, ingest_token, separator, fields, tags, parser, encoding, so
     """
 
     client = humioapi.HumioAPI(base_url=base_url, ingest_token=ingest_token)
-    fields = json.loads(fields)
-    tags = json.loads(tags)
-
-    for ingestfile in ingestfiles:
-        if not encoding:
-            detected = utils.detect_encoding(ingestfile)
-            if detected["confidence"] < 0.9:
-                logger.warning(
-                    "Detected encoding has low confidence",
-                    filedetection=detected,
-                    ingestfile=ingestfile,
-                )
-            if not detected["encoding"]:
-                logger.error(
-                    "Skipping file with unknown encoding",
-                    filedetection=detected,
-                    ingestfile=ingestfile,
-                )
-                continue
-            encoding = detected["encoding"]
-
-        with open(ingestfile, "r", encoding=encoding) as ingest_io:
-            client.ingest_unstructured(
-                events=utils.readevents_split(ingest_io, sep=separator),
-                fields=fields,
-                tags=tags,
-                parser=parser,
-                soft_limit=soft_limit,
-                dry=dry,
-            )
-
-    if not ingestfiles:
-        with click.open_file("-", "r") as ingest_stdin:
-            client.ingest_unstructured(
-                events=utils.readevents_split(ingest_stdin, sep=separator),
-                fields=fields,
-                tags=tags,
-                parser=parser,
-                soft_limit=soft_limit,
-                dry=dry,
+    fields = utils.json_loads(fields)
+    tags = utils.json_loads(tags)
+    separator = utils.compile_separator(separator)
+
+    def read_events():
+        """Yields events from all files, or STDIN if no files are provided"""
+
+        for ingestfile in ingestfiles:
+            file_encoding = encoding
+            if not file_encoding:
+                detected = utils.detect_encoding(ingestfile)
+                if detected["confidence"] < 0.9:
+                    logger.warning(
+                        "Detected encoding has low confidence",
+                        filedetection=detected,
+                        ingestfile=ingestfile,
+                    )
+                if not detected["encoding"]:
+                    logger.error(
+                        "Skipping file with unknown encoding",
+                        filedetection=detected,
+                        ingestfile=ingestfile,
+                    )
+                    continue
+                file_encoding = detected["encoding"]
+
+            with open(ingestfile, "r", encoding=file_encoding, buffering=READ_BUFFER_SIZE) as ingest_io:
+                yield from utils.readevents_split(ingest_io, sep=separator)
+
+        if not ingestfiles:
+            # Read STDIN through a larger buffer. It may not be backed by a file descriptor, for
+            # example when embedded, and the wrappers are detached afterwards to leave it open
+            ingest_stdin = io.TextIOWrapper(
+                io.BufferedReader(click.get_binary_stream("stdin"), READ_BUFFER_SIZE),
+                encoding=encoding or "utf-8",
+                errors="strict",
             )
+            try:
+                yield from utils.readevents_split(ingest_stdin, sep=separator)
+            finally:
+                ingest_stdin.detach().detach()
+
+    # A single stream of events lets small files share batches instead of sending at least one request each
+    client.ingest_unstructured(
+        events=read_events(),
+        fields=fields,
+        tags=tags,
+        parser=parser,
+        soft_limit=soft_limit,
+        dry=dry,
+    )
 
 
 @cli.command(short_help="Ingests pre-parsed events from CSV files into Humio")
@@ -592,8 +680,17 @@ def ingest(base_url, ingest_token, separator, fields, tags, parser, encoding, so
     help="Prepare ingestion without commiting any changes",
     cls=OptionWithEnvinfo,
 )
+@click.option(
+    "--workers",
+    envvar="HUMIO_WORKERS",
+    default=4,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="Maximum number of files to ingest concurrently",
+    cls=OptionWithEnvinfo,
+)
 @click.argument("ingestfiles", nargs=-1, type=click.Path(exists=True))
-def ingestcsv(base_url, ingest_token, tsfield, tags, dialect, encoding, dry, ingestfiles):
+def ingestcsv(base_url, ingest_token, tsfield, tags, dialect, encoding, dry, workers, ingestfiles):
     """
     Ingests events from CSV files as events with pre-parsed fields based on headers into Humio.
 
@@ -603,10 +700,11 @@ def ingestcsv(base_url, ingest_token, tsfield, tags, dialect, encoding, dry, ing
     """
 
     client = humioapi.HumioAPI(base_url=base_url, ingest_token=ingest_token)
-    tags = json.loads(tags)
+    tags = utils.json_loads(tags)
 
-    for ingestfile in ingestfiles:
-        if not encoding:
+    def ingest_file(ingestfile):
+        file_encoding = encoding
+        if not file_encoding:
             detected = utils.detect_encoding(ingestfile)
             if detected["confidence"] < 0.9:
                 logger.warning(
@@ -620,10 +718,15 @@ def ingestcsv(base_url, ingest_token, tsfield, tags, dialect, encoding, dry, ing
                     filedetection=detected,
                     ingestfile=ingestfile,
                 )
-                continue
-            encoding = detected["encoding"]
+                return
+            file_encoding = detected["encoding"]
+
+        client.ingest_csv(ingestfile, ts_field=tsfield, tags=tags, dialect=dialect, encoding=file_encoding, dry=dry)
 
-        client.ingest_csv(ingestfile, ts_field=tsfield, tags=tags, dialect=dialect, dry=dry)
+    # Each file is sent as a separate request, so overlap them rather than waiting on one at a time
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(ingestfiles)))) as executor:
+        # Consume the results to raise any exceptions from the workers
+        list(executor.map(ingest_file, ingestfiles))
 
 
 @cli.command(short_help="Upload a parser file to a repo")
@@ -666,6 +769,7 @@ def ingestcsv(base_url, ingest_token, tsfield, tags, dialect, encoding, dry, ing
     type=str,
     help="Ignore repositories and views with names matching the provided pattern. Pass the empty "
     "string to disable this option.",
+    callback=validate_regex,
     cls=OptionWithEnvinfo,
 )
 @click.option(
@@ -684,8 +788,18 @@ def ingestcsv(base_url, ingest_token, tsfield, tags, dialect, encoding, dry, ing
     help="Encoding to use when reading the provided files. Autodetected if not provided",
     cls=OptionWithEnvinfo,
 )
+@click.option(
+    "--no-cache",
+    "no_cache",
+    envvar="HUMIO_NO_CACHE",
+    is_flag=True,
+    default=False,
+    help="Always fetch a fresh list of repositories and views instead of reusing one cached in "
+    "~/.cache/humio for up to 60 seconds.",
+    cls=OptionWithEnvinfo,
+)
 @click.argument("parser", nargs=1, type=click.Path(exists=True))
-def makeparser(base_url, token, repo_, ignore_repo, strict_views, encoding, parser):
+def makeparser(base_url, token, repo_, ignore_repo, strict_views, encoding, no_cache, parser):
     """
     Takes a parser file and creates or updates a parser with the same name as the file
     in the requested repository (or repositories).
@@ -695,21 +809,29 @@ def makeparser(base_url, token, repo_, ignore_repo, strict_views, encoding, pars
 
     client = humioapi.HumioAPI(base_url=base_url, token=token)
 
-    target_repos = [
-        name
-        for name in utils.filter_repositories(
-            client.repositories(),
-            repo_,
-            ignore=ignore_repo,
-            strict_views=strict_views,
-            parseradmin_permission=True,
-        ).keys()
-    ]
-    if "sandbox" in repo_:
+    if not any(utils.GLOB_CHARS.search(pattern) for pattern in repo_):
+        # Exact names need no repository listing, Humio rejects the ones we can't create parsers in
+        target_repos = [name for name in dict.fromkeys(repo_) if not (ignore_repo and re.search(ignore_repo, name))]
+    else:
+        repositories = utils.cached_repositories(client, ttl=0 if no_cache else 60)
+        target_repos = list(
+            utils.filter_repositories(
+                repositories,
+                repo_,
+                ignore=ignore_repo,
+                strict_views=strict_views,
+                parseradmin_permission=True,
+            )
+        )
+    if "sandbox" in repo_ and "sandbox" not in target_repos:
         # Humio maps sandbox to the current user's sandbox so we shouldn't
         # have to require the full name (sandbox-<some-long-id-here>)
         target_repos.append("sandbox")
 
+    parser_size = os.path.getsize(parser)
+    if parser_size > 2 ** 20:
+        logger.warning("Parser file is unexpectedly large, is this the right file?", parser=parser, size=parser_size)
+
     if not encoding:
         detected = utils.detect_encoding(parser)
         if detected["confidence"] < 0.9:
@@ -805,16 +927,18 @@ def urlsearch(ctx, dry, url):
     safe_query = '"$(cat << HUMIOQUERY\n' + query + "\nHUMIOQUERY\n" + ')"'
 
     if safe_options:
-        command = f'hc search --repo={repo_} --start="{start}" --stop="{stop}" {" ".join(safe_options)} {safe_query}'
+        command = f'hc search --repo={repo_} --start="{start}" --stop="{stop}" {" ".join(safe_options)} -- {safe_query}'
     else:
-        command = f'hc search --repo={repo_} --start="{start}" --stop="{stop}" {safe_query}'
+        command = f'hc search --repo={repo_} --start="{start}" --stop="{stop}" -- {safe_query}'
 
     click.echo(" > Humio command: " + click.style(command, fg="green"), err=True)
 
     if not dry:
-        subprocess.run(
-            ["hc", "search", "--repo", repo_, "--start", str(start), "--stop", str(stop)] + options + [query]
-        )
+        # Run the search in this process instead of starting a new hc process. The query is
+        # passed after -- so a query starting with a dash isn't parsed as an option
+        argv = ["--repo", repo_, "--start", str(start), "--stop", str(stop)] + ctx.args + ["--", query]
+        with search.make_context("search", argv, parent=ctx.parent) as search_ctx:
+            search.invoke(search_ctx)
 
 
 if __name__ == "__main__":
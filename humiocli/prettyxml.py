@@ -11,16 +11,24 @@ re_opening_tag = re.compile(r"<(?:[^<>/\s]+)[^>]*(?<!/)>")
 re_closing_tag = re.compile(r"<[/].*?>")
 re_namespace = re.compile(r""" xmlns[^\"']+['\"][^\"']+[\"']""")
 re_namespace_prefix = re.compile(r"""(<\/?)[^:<> ]{0,20}:""")
+# Namespace declarations or tag prefixes, replacing matches with the group drops both in one pass
+re_namespaces = re.compile(re_namespace_prefix.pattern + "|" + re_namespace.pattern)
+re_tag_whitespace = re.compile(r"\s*(<[^<>]+>)\s*", re.M)
+re_preface = re.compile(r"(<[^<>]+)(<)")
 
 
 def process(rawstring, strip=True, clean=True, repair=False, output_format="pretty", indentation="    "):
+    # nothing to do for text without any tags (or stray namespace declarations when cleaning)
+    if "<" not in rawstring and not (clean and "xmlns" in rawstring):
+        return rawstring
+
     if strip:
-        rawstring = re.sub(r"\s*(<[^<>]+>)\s*", r"\1", rawstring, flags=re.M)
+        rawstring = re_tag_whitespace.sub(r"\1", rawstring)
     if clean:
         rawstring = clean_tags(rawstring)
 
     # keep very obvious non-xml unprocessed
-    parts = re.split("""(<[^<>]+)(<)""", rawstring, maxsplit=1)
+    parts = re_preface.split(rawstring, maxsplit=1)
     if len(parts) == 4:
         preface = parts[0] + parts[1]
         rawstring = parts[2] + parts[3]
@@ -44,69 +52,85 @@ def process(rawstring, strip=True, clean=True, repair=False, output_format="pret
 
 def prettify(xml_parts, indent="  "):
     indent_count = 0
+    indents = [""]
     prettified = []
+    append = prettified.append
+    previous_part = ""
 
-    for idx, part in enumerate(xml_parts):
+    for part in xml_parts:
 
         if re_tag.match(part):
-            if part[1] == "/":  # Closing
+            marker = part[1]
+            if marker == "/":  # Closing
                 indent_count -= 1 if indent_count > 0 else 0
-                previous_part = xml_parts[idx - 1] if idx > 0 else ""
                 if previous_part[:2] == "</" or previous_part[-2:] == "/>":
-                    prettified.append("\n%s%s" % (indent * indent_count, part))
+                    append(f"\n{indents[indent_count]}{part}")
                 else:
-                    prettified.append("%s" % (part))
+                    append(part)
 
-            elif part[1] == "?":  # Prolog
-                prettified.append("%s%s" % (indent * indent_count, part))
+            elif marker == "?":  # Prolog
+                append(indents[indent_count] + part)
 
             elif part[-2] == "/":  # Self-containing
-                prettified.append("\n%s%s" % (indent * indent_count, part))
+                append(f"\n{indents[indent_count]}{part}")
 
-            elif part[1] == "!":  # CDATA
-                prettified.append(part)
+            elif marker == "!":  # CDATA
+                append(part)
 
             else:  # Opening
-                prettified.append("\n%s%s" % (indent * indent_count, part))
+                append(f"\n{indents[indent_count]}{part}")
                 indent_count += 1
+                if indent_count == len(indents):
+                    indents.append(indents[-1] + indent)
 
         else:  # Value
-            previous_part = xml_parts[idx - 1] if idx > 0 else ""
             if previous_part[:2] == "</" or previous_part[-2:] == "/>":
-                part = "\n" + part
-            prettified.append(part)
+                append("\n" + part)
+            else:
+                append(part)
+
+        previous_part = part
     return prettified
 
 
 def key_value(xml_parts, indent="  "):
     indent_count = 0
+    indents = [""]
     kv = []
+    append = kv.append
+    previous_part = ""
 
-    for idx, part in enumerate(xml_parts):
+    for part in xml_parts:
         if re_tag.match(part):
-            if part[1] == "/":  # Closing
+            marker = part[1]
+            if marker == "/":  # Closing
                 indent_count -= 1 if indent_count > 0 else 0
-            elif part[1] == "?":  # Prolog - Does anyone using this format care about these?
-                continue
+            elif marker == "?":  # Prolog - Does anyone using this format care about these?
+                pass
             elif part[-2] == "/":  # Self-containing
-                kv.append("\n%s%s" % (indent * indent_count, part[1:-2] + ":"))
-            elif part[1] == "!":  # CDATA
-                kv.append(part)
+                append(f"\n{indents[indent_count]}{part[1:-2]}:")
+            elif marker == "!":  # CDATA
+                append(part)
             else:  # Opening
-                kv.append("\n%s%s" % (indent * indent_count, part[1:-1] + ": "))
+                append(f"\n{indents[indent_count]}{part[1:-1]}: ")
                 indent_count += 1
+                if indent_count == len(indents):
+                    indents.append(indents[-1] + indent)
         else:  # Value
-            previous_part = xml_parts[idx - 1] if idx > 0 else ""
             if previous_part[:2] == "</" or previous_part[-2:] == "/>":
-                part = "\n" + part
-            kv.append(part)
+                append("\n" + part)
+            else:
+                append(part)
+
+        previous_part = part
     return kv
 
 
 def clean_tags(xml):
-    xml = re_namespace.sub("", xml)
-    xml = re_namespace_prefix.sub(r"\1", xml)
-    return xml
+    # both patterns need one of these to match, so most plain markup can skip the regex entirely
+    if ":" not in xml and "xmlns" not in xml:
+        return xml
+    return re_namespaces.sub(r"\1", xml)
 
 
 def repair_tags(xml_parts):
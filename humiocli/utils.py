@@ -2,27 +2,62 @@
 Collection of misc utility functions
 """
 
+import os
 import re
 import sys
 import json
-from fnmatch import fnmatch
+import time
+import codecs
+import hashlib
+import tempfile
+import fnmatch
+from pathlib import Path
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 from collections import defaultdict
 
-from tabulate import tabulate
 import colorama
-import pandas as pd
-import snaptime
 import structlog
-from pygments import highlight as hl
-from pygments.formatters import Terminal256Formatter  # pylint: disable=no-name-in-module
-from pygments.lexers import XmlLexer  # pylint: disable=no-name-in-module
-from pygments.lexers.data import JsonLexer
+
+try:
+    import orjson
+except ImportError:  # Optional, speeds up JSON serialization if installed
+    orjson = None
 
 logger = structlog.getLogger(__name__)
 
 # Regex for extracting JSON values that look like XML
 JSON_XML_FIELD = re.compile(r':\s*"\s*(?P<xml_field><(?P<tag>[^">]+)>[^"][^"]+<\/(?P=tag)>)\s*"')
 
+# Byte order marks and their encodings, UTF-32 must be checked before UTF-16
+BYTE_ORDER_MARKS = [
+    (codecs.BOM_UTF32_LE, "UTF-32"),
+    (codecs.BOM_UTF32_BE, "UTF-32"),
+    (codecs.BOM_UTF8, "UTF-8-SIG"),
+    (codecs.BOM_UTF16_LE, "UTF-16"),
+    (codecs.BOM_UTF16_BE, "UTF-16"),
+]
+
+# Separators compiled by `compile_separator` that are only a `^` anchor and literal text,
+# which can be checked with str.startswith instead of the regex
+LITERAL_SEPARATOR = re.compile(r"\(\^((?:[^\\.^$*+?{}\[\]|()]|\\\W)+)\)")
+
+# Start of Unix time, for converting Humio's millisecond timestamps
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Regex for detecting fnmatch patterns containing wildcards
+GLOB_CHARS = re.compile(r"[*?\[]")
+
+# Preconfigured standard library encoders keyed on (sort_keys, compact), for regular output and
+# for compact output when orjson is missing or rejects an object
+JSON_ENCODERS = {
+    (sort_keys, compact): json.JSONEncoder(
+        ensure_ascii=False, sort_keys=sort_keys, separators=(",", ":") if compact else (", ", ": ")
+    ).encode
+    for sort_keys in (False, True)
+    for compact in (False, True)
+}
+
 
 def color_init(color):
     """Enable/Disable wrapping of sys.stdout with Colorama logic"""
@@ -35,10 +70,39 @@ def color_init(color):
         colorama.init(strip=True)
 
 
+def json_dumps(obj, sort_keys=False, compact=False):
+    """
+    Returns a JSON string with non-ASCII characters left intact, formatted like `json.dumps`
+    unless `compact` is set. Compact output has no spaces after separators and uses orjson
+    if it is installed, with a fallback to the standard library for anything orjson rejects
+    """
+    if compact and orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0).decode()
+        except TypeError:
+            pass
+    return JSON_ENCODERS[bool(sort_keys), bool(compact)](obj)
+
+
+def json_loads(data):
+    """
+    Parses a JSON document from a string or bytes. Uses orjson if it is installed, with
+    a fallback to the standard library for anything orjson rejects (such as NaN)
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except ValueError:
+            pass
+    return json.loads(data)
+
+
 def wrap_time(timestamp, offset):
     """
     Takes a datetime object and adjusts it with with the provided snaptime-offset
     """
+    import snaptime
+
     return snaptime.snap(timestamp, offset)
 
 
@@ -77,20 +141,65 @@ def run_ipython(ns):
     start_ipython(argv=[], config=config, user_ns=ns)
 
 
-def detect_encoding(unknown_file):
-    """Sniff a file's contents and try to detect the encoding used with chardet"""
+def detect_encoding(unknown_file, max_bytes=2 ** 21, chunk_size=2 ** 16):
+    """
+    Sniff a file's contents and try to detect the encoding used, either from a byte
+    order mark, by checking for valid UTF-8 or with chardet. The whole file is checked
+    for valid UTF-8 chunk by chunk, and if that fails chardet is fed up to `max_bytes`
+    bytes from where the invalid bytes begin, until it is confident. Results are
+    remembered for as long as the file is unmodified.
+    """
 
-    import chardet
+    stat = os.stat(unknown_file)
+    return dict(_detect_encoding(unknown_file, stat.st_mtime_ns, stat.st_size, max_bytes, chunk_size))
 
-    detector = chardet.UniversalDetector()
+
+@lru_cache(maxsize=256)
+def _detect_encoding(unknown_file, mtime, size, max_bytes, chunk_size):  # pylint: disable=unused-argument
+    """Cached implementation of `detect_encoding`, keyed on the file's modification time and size"""
+
+    import chardet
 
     with open(unknown_file, "rb") as unknown_io:
-        for line in unknown_io:
-            detector.feed(line)
-            if detector.done:
+        head = unknown_io.read(chunk_size)
+
+        for bom, encoding in BYTE_ORDER_MARKS:
+            if head.startswith(bom):
+                return {"encoding": encoding, "confidence": 1.0, "language": ""}
+
+        # Valid UTF-8 (including plain ASCII) is by far the most common case and cheap to verify,
+        # but an ASCII head says nothing about the rest of the file, so check all of it
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        chunk, checked = head, 0
+        try:
+            while chunk:
+                decoder.decode(chunk)
+                checked += len(chunk)
+                chunk = unknown_io.read(chunk_size)
+            decoder.decode(b"", final=True)
+            return {"encoding": "utf-8", "confidence": 0.99, "language": ""}
+        except UnicodeDecodeError:
+            # Everything before the chunk that failed is valid UTF-8 and tells chardet nothing, but
+            # a character may have started up to 3 bytes before it
+            unknown_io.seek(max(checked - 3, 0))
+
+        detector = chardet.UniversalDetector()
+        inspected = 0
+        while not detector.done and inspected < max_bytes:
+            chunk = unknown_io.read(min(chunk_size, max_bytes - inspected))
+            if not chunk:
                 break
-    detector.close()
-    return detector.result
+            detector.feed(chunk)
+            inspected += len(chunk)
+        detector.close()
+        return detector.result
+
+
+def compile_separator(sep):
+    """
+    Returns a compiled start of record separator pattern suitable for `readevents_split`
+    """
+    return re.compile("(" + sep + ")", flags=re.MULTILINE | re.DOTALL)
 
 
 def readevents_split(io, sep="^."):
@@ -99,6 +208,9 @@ def readevents_split(io, sep="^."):
     after reading the file object line by line. Do not use trailing/end-of-record
     patterns (for example `\n` ) or results will probably not be as expected.
 
+    The separator may be a pattern string or a pattern already compiled with
+    `compile_separator`, which avoids compiling it again for every file.
+
     A final trailing newline is stripped from each event if any. All other whitespaces
     are left intact.
     """
@@ -107,39 +219,73 @@ def readevents_split(io, sep="^."):
         """Perl-like chomp, strip final newlines but keep whitespaces unlike rstrip"""
         if x.endswith("\r\n"):
             return x[:-2]
-        if x.endswith("\n") or x.endswith("\r"):
+        if x.endswith(("\n", "\r")):
             return x[:-1]
         return x
 
-    sep = re.compile("(" + sep + ")", flags=re.MULTILINE | re.DOTALL)
-    buffer = ""
+    if isinstance(sep, str):
+        sep = compile_separator(sep)
 
-    while True:
-        line = io.readline()
+    if sep.pattern == "(^.)":
+        # Every line starts a new event with the default separator, so skip the regex entirely.
+        # Like the general case below, empty input still yields a single empty event
+        line = ""
+        for line in io:
+            yield chomp(line)
         if not line:
-            break  # EOF
+            yield ""
+        return
+
+    literal = LITERAL_SEPARATOR.fullmatch(sep.pattern)
+    prefix = re.sub(r"\\(.)", r"\1", literal.group(1)) if literal else None
+
+    # Lines of the event being read, joined once the event is complete to keep the work
+    # linear for events spanning many lines. The separator is matched one line at a time
+    buffer = []
+
+    for line in io:
+        if prefix is not None and not line.startswith(prefix):
+            # The separator can only match at the start of a line, so this line continues the event
+            buffer.append(line)
+            continue
 
         # `pending_events` will hold possibly partial events whenever a match of `sep`
         # occurs. We won't know if there are additional lines belonging to the last
         # event until we either see a new separator or the whole file has been processed
         # `continuation` holds non-matches, which belong to the previous event
         continuation, *parts = sep.split(line)
-        pending_events = [a + b for a, b in zip(parts[::2], parts[1::2])]
-        # print('continuation:', repr(continuation), 'pending_events:', repr(pending_events))
 
         if continuation:
-            buffer += continuation
+            buffer.append(continuation)
 
-        if pending_events:
+        if parts:
+            pending_events = [a + b for a, b in zip(parts[::2], parts[1::2])]
             *complete, incomplete = pending_events
 
             if buffer:
-                yield chomp(buffer)
+                yield chomp("".join(buffer))
 
-            buffer = incomplete
+            buffer = [incomplete] if incomplete else []
             for event in complete:
                 yield chomp(event)
-    yield chomp(buffer)
+    yield chomp("".join(buffer))
+
+
+@lru_cache(maxsize=None)
+def _terminal_formatter(style):
+    """Returns a shared terminal formatter for the style, building one resolves the whole style"""
+    from pygments.formatters import Terminal256Formatter  # pylint: disable=no-name-in-module
+
+    return Terminal256Formatter(style=style)
+
+
+@lru_cache(maxsize=None)
+def _lexers():
+    """Returns shared XML and JSON lexers, they keep no state between calls"""
+    from pygments.lexers import XmlLexer  # pylint: disable=no-name-in-module
+    from pygments.lexers.data import JsonLexer
+
+    return XmlLexer(), JsonLexer()
 
 
 def highlight(rawstring, style):
@@ -148,16 +294,22 @@ def highlight(rawstring, style):
     highlighting style
     """
 
-    xmllexer = XmlLexer()
-    jsonlexer = JsonLexer()
-    termformatter = Terminal256Formatter(style=style)
+    # Imported here since Pygments is slow to import and only needed for colorized output
+    from pygments import highlight as hl
+
+    xmllexer, jsonlexer = _lexers()
+    termformatter = _terminal_formatter(style)
 
     # TODO: Consider finding xml/json substrings and highlighting with re.sub(,,repl())
     #       Chaining overlapping strings with pygments lexers seems unstable
 
     try:
-        if rawstring.lstrip().startswith("{") and rawstring.rstrip().endswith("}"):
+        stripped = rawstring.strip()
+        if stripped.startswith("{") and stripped.endswith("}"):
             rawstring = hl(rawstring, jsonlexer, termformatter)
+            if "<" not in stripped:
+                # No embedded markup, and another pass would only recolor whitespace and punctuation
+                return rawstring.strip()
         rawstring = hl(rawstring, xmllexer, termformatter)
         return rawstring.strip()
     except Exception as err:
@@ -165,7 +317,7 @@ def highlight(rawstring, style):
         return rawstring
 
 
-def searchstring_from_fields(events, outformat, ignored=None):
+def searchstring_from_fields(events, outformat, ignored=None, max_values=10000):
     """
     Generate Humio search strings from all available fields in all events by OR-ing all
     values (if outformat is or-values), or fields and values (if outformat is or-fields).
@@ -180,6 +332,9 @@ def searchstring_from_fields(events, outformat, ignored=None):
         The template name to use, either `or-fields` or `or-values`
     ignored : list, optional
         A list of fields that should be ignored. By default ["@timestamp", "@rawstring"]
+    max_values : int, optional
+        Maximum number of unique values to keep per field, additional values are
+        dropped with a warning to keep memory bounded. By default 10000
 
     Returns
     -------
@@ -189,52 +344,110 @@ def searchstring_from_fields(events, outformat, ignored=None):
 
     if ignored is None:
         ignored = ["@timestamp", "@rawstring"]
+    ignored = frozenset(ignored)
 
-    if outformat == "or-values":
-        template = "{value}"
-    else:
-        template = "{field}={value}"
+    with_fields = outformat != "or-values"
 
-    data = defaultdict(set)
+    # Unique values per field mapped to their JSON form. Strings and other simple values are
+    # only serialized once they are emitted, anything else is serialized since that is its key
+    data = defaultdict(dict)
+    truncated = set()
+    scalars = (int, float, bool, type(None))
 
     for event in events:
         for field, value in event.items():
             if field in ignored:
                 continue
-            data[field].add(template.format(field=json.dumps(field), value=json.dumps(value)))
+            values = data[field]
+            # Humio fields are nearly always strings, other values are keyed on their type since 1 == 1.0 == True
+            if value.__class__ is str:
+                key = value
+                serialized = None
+            elif value.__class__ in scalars:
+                key = (value.__class__, value)
+                serialized = None
+            else:
+                serialized = json_dumps(value)
+                key = (value.__class__, serialized)
+            if key in values:
+                continue
+            if len(values) >= max_values:
+                truncated.add(field)
+                continue
+            values[key] = serialized
+    if truncated:
+        logger.warning(
+            "Some fields have too many unique values, additional values were dropped",
+            fields=sorted(truncated),
+            max_values=max_values,
+        )
     if len(data.keys()) > 5:
         logger.warning(
             "The emitted searching includes more than 5 fields, did you forget select relevant fields?",
             fields=sorted(data.keys()),
         )
-    data = {key: " or ".join(values) for key, values in data.items()}
-    data["SUBSEARCH"] = "(" + ") and (".join([value for key, value in data.items()]) + ")"
-    return data
+    searchstrings = []
+    for field, values in data.items():
+        prefix = json_dumps(field) + "=" if with_fields else ""
+        terms = []
+        for key, serialized in values.items():
+            if serialized is None:
+                serialized = json_dumps(key if key.__class__ is str else key[1])
+            terms.append(prefix + serialized)
+        searchstrings.append((field, " or ".join(terms)))
+    subsearch = "(" + ") and (".join(searchstring for _, searchstring in searchstrings) + ")"
+    return dict(searchstrings, SUBSEARCH=subsearch)
 
 
 def table_from_events(events, leading=None, trailing=None, drop=None):
-    df = pd.DataFrame.from_dict(events)
+    """
+    Returns the events formatted as a table with one column per field, with the
+    `leading` and `trailing` fields first and last. Humio's millisecond `@timestamp`
+    is shown as an UTC datetime.
+    """
+    from tabulate import tabulate
+
+    events = list(events)
+    # All fields in order of first appearance, as a dict for fast membership tests
+    fields = dict.fromkeys(field for event in events for field in event)
+
     if leading is None:
         leading = ["timestamp", "@timestamp"]
     if trailing is None:
         trailing = ["#repo", "#type", "@host", "@source", "@timezone", "@id", "@rawstring"]
     if drop is None:
-        if "timestamp" in df.columns:
+        if "timestamp" in fields:
             drop = ["@timestamp", "@timezone"]
         else:
             drop = []
 
-    df = df.drop(columns=drop, errors="ignore")
-    if "@timestamp" in df.columns:
-        df["@timestamp"] = pd.to_datetime(df["@timestamp"], unit="ms", utc=True)
+    for field in drop:
+        fields.pop(field, None)
+    leading = [x for x in leading if x in fields]
+    trailing = [x for x in trailing if x in fields and x not in leading]
+    ordered = set(leading).union(trailing)
+    middle = [x for x in fields if x not in ordered]
+    columns = leading + middle + trailing
+
+    rows = [[event.get(column) for column in columns] for event in events]
+
+    if "@timestamp" in columns:
+        idx = columns.index("@timestamp")
+        for row in rows:
+            if isinstance(row[idx], (int, float)):
+                # Formatted here so tabulate only has to handle text in this column
+                row[idx] = str(EPOCH + timedelta(milliseconds=row[idx]))
+
+    return tabulate(rows, headers=columns, missingval="")
 
-    leading = [x for x in leading if x in df.columns]
-    trailing = [x for x in trailing if x in df.columns and x not in leading]
-    middle = [x for x in df.columns if x not in leading and x not in trailing]
-    df = df[leading + middle + trailing]
 
-    df = df.fillna("")
-    return tabulate(df, headers=df.columns, showindex=False)
+@lru_cache(maxsize=256)
+def compile_globs(patterns):
+    """
+    Returns a single compiled regex matching any of the provided fnmatch patterns (a tuple),
+    memoized between calls
+    """
+    return re.compile("|".join("(?:" + fnmatch.translate(pattern) + ")" for pattern in patterns))
 
 
 def filter_repositories(repositories, patterns=None, ignore=None, strict_views=True, **kwargs):
@@ -265,6 +478,12 @@ def filter_repositories(repositories, patterns=None, ignore=None, strict_views=T
         patterns = ["*"]
     matching_repositories = {}
 
+    # Literal names only need a set lookup, while globs are combined into a single regex
+    literals = {pattern for pattern in patterns if not GLOB_CHARS.search(pattern)}
+    globs = tuple(pattern for pattern in patterns if pattern not in literals)
+    glob = compile_globs(globs) if globs else None
+    ignore = re.compile(ignore) if ignore else None
+
     def _check_attributes(repository, attributes):
         for attr, value in attributes.items():
             if attr not in repository:
@@ -273,27 +492,109 @@ def filter_repositories(repositories, patterns=None, ignore=None, strict_views=T
                 return False
         return True
 
-    for name, repository in repositories.items():
-        for pattern in patterns:
-            if strict_views and repository.get("type") == "view" and name != pattern:
-                # Views must match exactly in strict mode, try next pattern
-                continue
+    if globs:
+        candidates = repositories.items()
+    else:
+        # Only literal names, so look them up directly instead of scanning every repository
+        candidates = [(name, repositories[name]) for name in dict.fromkeys(patterns) if name in repositories]
+
+    for name, repository in candidates:
+        if name in literals:
+            # Exact match, valid for both repositories and views
+            pass
+        elif strict_views and repository.get("type") == "view":
+            # Views must match exactly in strict mode
+            continue
+        elif not glob.match(name):
+            # No fnmatch
+            continue
+
+        if ignore and ignore.search(name):
+            # Repo should be ignored
+            continue
+
+        if not _check_attributes(repository, kwargs):
+            # At least one attribute requirement does not match
+            continue
+
+        matching_repositories[name] = repository
 
-            if not fnmatch(name, pattern):
-                # No fnmatch, try next pattern
-                continue
+    return matching_repositories
 
-            if ignore and re.search(ignore, name):
-                # Repo should be ignored
-                continue
 
-            if not _check_attributes(repository, kwargs):
-                # At least one attribute requirement does not match
-                continue
+def cached_repositories(client, fast=False, ttl=60):
+    """
+    Returns `client.repositories()`, reusing a recent result cached on disk for the
+    same base URL and token so repeated invocations skip the GraphQL round-trip.
 
-            matching_repositories[name] = repository
+    Parameters
+    ----------
+    client : humioapi.HumioAPI
+        An API client with a valid token
+    fast : bool, optional
+        Passed along to `humioapi.HumioAPI.repositories()`, by default False
+    ttl : int, optional
+        Maximum age of a cached result in seconds, by default 60. Use 0 to disable the cache
 
-    return matching_repositories
+    Returns
+    -------
+    dict
+        A dictionary of repo names and their properties
+    """
+
+    key = hashlib.blake2b(f"{client.base_url}|{client.token}|{fast}".encode(), digest_size=16).hexdigest()
+    cache_file = Path.home() / ".cache/humio" / f"repositories-{key}.json"
+
+    try:
+        if time.time() - cache_file.stat().st_mtime < ttl:
+            with open(cache_file, "rb") as cache_io:
+                logger.debug("Using cached repositories", cache_file=str(cache_file))
+                return _load_repositories(cache_io.read())
+    except (OSError, ValueError, TypeError, AttributeError) as err:
+        logger.debug("Unable to use cached repositories", cache_file=str(cache_file), error=err)
+
+    repositories = client.repositories(fast=fast)
+
+    if ttl > 0:
+        temp_file = None
+        try:
+            # Repository names and permissions are private to the user, so keep them unreadable by others.
+            # The cache is written to a temporary file (created with mode 0600) and moved into place, so
+            # concurrent readers never see a partially written file
+            cache_file.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+            cache_file.parent.chmod(0o700)
+            cache_fd, temp_file = tempfile.mkstemp(dir=cache_file.parent, prefix=cache_file.stem, suffix=".tmp")
+            with open(cache_fd, "w", encoding="utf-8") as cache_io:
+                cache_io.write(_dump_repositories(repositories))
+            os.replace(temp_file, cache_file)
+        except OSError as err:
+            logger.debug("Unable to cache repositories", cache_file=str(cache_file), error=err)
+            if temp_file is not None and os.path.exists(temp_file):
+                os.unlink(temp_file)
+    return repositories
+
+
+def _dump_repositories(repositories):
+    """Serializes repositories to JSON, with `last_ingest` timestamps as ISO8601 strings"""
+
+    return json_dumps(
+        {
+            name: {**meta, "last_ingest": meta["last_ingest"].isoformat()} if meta.get("last_ingest") else meta
+            for name, meta in repositories.items()
+        }
+    )
+
+
+def _load_repositories(data):
+    """Inverse of `_dump_repositories`, parsing `last_ingest` timestamps back to pendulum datetimes"""
+
+    import pendulum
+
+    repositories = json_loads(data)
+    for meta in repositories.values():
+        if meta.get("last_ingest"):
+            meta["last_ingest"] = pendulum.parse(meta["last_ingest"])
+    return repositories
 
 
 def is_tty():
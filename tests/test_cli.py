@@ -0,0 +1,60 @@
+import humioapi
+import pytest
+from click.testing import CliRunner
+
+from humiocli.cli import cli
+
+
+@pytest.fixture
+def ingested(monkeypatch):
+    """Collects the events passed to HumioAPI.ingest_unstructured instead of sending them"""
+
+    ingested = []
+
+    def ingest_unstructured(self, events, **kwargs):
+        ingested.extend(events)
+
+    monkeypatch.setattr(humioapi.HumioAPI, "ingest_unstructured", ingest_unstructured)
+    return ingested
+
+
+def test_ingest_stdin(ingested):
+    result = CliRunner().invoke(
+        cli, ["ingest", "-b", "http://localhost", "--ingest-token", "t"], input="first\nsecond\nblåbær\n".encode()
+    )
+    assert result.exit_code == 0, result.output
+    assert ingested == ["first", "second", "blåbær"]
+
+
+def test_ingest_stdin_with_encoding(ingested):
+    result = CliRunner().invoke(
+        cli,
+        ["ingest", "-b", "http://localhost", "--ingest-token", "t", "--encoding", "latin-1"],
+        input="first\nblåbær\n".encode("latin-1"),
+    )
+    assert result.exit_code == 0, result.output
+    assert ingested == ["first", "blåbær"]
+
+
+def test_urlsearch_query_starting_with_dash(monkeypatch):
+    searched = []
+
+    def streaming_search(self, query, repo, start, stop, **kwargs):
+        searched.append((query, repo))
+        return iter([])
+
+    monkeypatch.setattr(humioapi.HumioAPI, "streaming_search", streaming_search)
+    result = CliRunner().invoke(
+        cli,
+        ["urlsearch", "https://cloud.humio.com/sandbox/search?query=-foo&start=1612345678000&end=1612349278000"],
+        env={"HUMIO_BASE_URL": "http://localhost", "HUMIO_TOKEN": "t"},
+    )
+    assert result.exit_code == 0, result.output
+    assert searched == [("-foo", "sandbox")]
+
+
+def test_invalid_ignore_repo_pattern():
+    result = CliRunner().invoke(cli, ["repo", "-b", "http://localhost", "-t", "t", "--ignore-repo", "(unclosed"])
+    assert result.exit_code == 2
+    assert "Invalid value for" in result.output
+    assert "Invalid regex" in result.output
@@ -0,0 +1,87 @@
+import io
+
+import pytest
+
+from humiocli import utils
+
+
+def test_detect_encoding_large_utf8(tmp_path):
+    large = tmp_path / "large.log"
+    large.write_bytes("blåbærsyltetøy\n".encode("utf-8") * 200_000)
+    assert large.stat().st_size > 2 ** 21
+
+    detected = utils.detect_encoding(large)
+    assert detected["encoding"] == "utf-8"
+    assert detected["confidence"] >= 0.9
+
+
+def test_detect_encoding_latin1_after_large_ascii_head(tmp_path):
+    mixed = tmp_path / "mixed.log"
+    mixed.write_bytes(b"plain ascii line\n" * 200_000 + "blåbærsyltetøy\n".encode("latin-1") * 100)
+    assert mixed.stat().st_size > 2 ** 21
+
+    detected = utils.detect_encoding(mixed)
+    assert detected["encoding"].lower() not in ("ascii", "utf-8")
+    mixed.read_bytes().decode(detected["encoding"])
+
+
+class FakeClient:
+    base_url = "http://localhost"
+    token = "secret"
+
+    def __init__(self, repositories):
+        self.calls = 0
+        self._repositories = repositories
+
+    def repositories(self, fast=False):
+        self.calls += 1
+        return self._repositories
+
+
+def test_cached_repositories(tmp_path, monkeypatch):
+    import pendulum
+
+    monkeypatch.setenv("HOME", str(tmp_path))
+    repositories = {
+        "active": {"type": "repo", "read_permission": True, "last_ingest": pendulum.datetime(2021, 2, 3, 4, 5, 6)},
+        "idle": {"type": "view", "read_permission": False, "last_ingest": None},
+    }
+    client = FakeClient(repositories)
+
+    assert utils.cached_repositories(client) == repositories
+    assert utils.cached_repositories(client) == repositories
+    assert client.calls == 1
+
+    cache_dir = tmp_path / ".cache/humio"
+    (cache_file,) = cache_dir.iterdir()
+    assert cache_file.suffix == ".json"
+    assert cache_dir.stat().st_mode & 0o777 == 0o700
+    assert cache_file.stat().st_mode & 0o777 == 0o600
+
+    assert utils.cached_repositories(client, ttl=0) == repositories
+    assert client.calls == 2
+
+    cache_file.write_text("{not json")
+    assert utils.cached_repositories(client) == repositories
+    assert client.calls == 3
+
+
+@pytest.mark.parametrize("text", ["", "\n", "one", "one\n", "one\r\ntwo\n\nthree\n"])
+def test_readevents_split_default_separator(text):
+    # The equivalent non-capturing separator is not recognized as the default, so it takes the general path
+    general = list(utils.readevents_split(io.StringIO(text), sep="(?:^.)"))
+    assert list(utils.readevents_split(io.StringIO(text))) == general
+
+
+def test_readevents_split_empty_input():
+    assert list(utils.readevents_split(io.StringIO(""))) == [""]
+    assert list(utils.readevents_split(io.StringIO(""), sep="^#")) == [""]
+
+
+def test_json_dumps_matches_standard_library():
+    import json
+
+    event = {"b": [1, 2.5, None], "a": {"nested": "blåbær"}, "@rawstring": "x"}
+    assert utils.json_dumps(event, sort_keys=True) == json.dumps(event, ensure_ascii=False, sort_keys=True)
+    assert json.loads(utils.json_dumps(event, sort_keys=True, compact=True)) == event
+    assert ", " not in utils.json_dumps(event, compact=True)